@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Time creating entries through /new against creating them through /batch
+
+/new writes one entry, commits, fetches it back by its summary and renders
+it; /batch writes up to MAX_BATCH entries with one INSERT and renders them
+from the returned rows. This calls the add_entry and add_entries views as
+the router would, committing after each request like the transaction
+manager, for --count entries each, and deletes the entries it made.
+
+    python benchmarks/bench_batch.py --count 1000 --batch 100
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import closing
+
+from pyramid import testing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+
+
+def post_new(db, items):
+    """create items one per request, returning their ids"""
+    ids = []
+    for item in items:
+        request = testing.DummyRequest(post=item, params=item, db=db)
+        ids.append(journal.add_entry(request)['id'])
+        db.commit()
+    return ids
+
+
+def post_batch(db, items, size):
+    """create items size at a time, returning their ids"""
+    ids = []
+    for idx in range(0, len(items), size):
+        request = testing.DummyRequest(
+            method='POST', json_body=items[idx:idx + size], db=db)
+        entries = journal.add_entries(request)['entries']
+        ids.extend(entry['id'] for entry in entries)
+        db.commit()
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get(
+        'DATABASE_URL', 'dbname=test_learning_journal user=henryhowes'))
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=journal.MAX_BATCH)
+    args = parser.parse_args()
+
+    items = [{'title': 'Entry {}'.format(idx),
+              'text': 'Some *markdown* for entry {}'.format(idx)}
+             for idx in range(args.count)]
+    config = testing.setUp(settings={'entries.max_batch': args.batch})
+    config.testing_securitypolicy(userid='admin')
+    created = []
+    try:
+        with closing(journal.connect_db({'db': args.dsn})) as db:
+            db.cursor().execute(journal.DB_SCHEMA)
+            db.commit()
+            try:
+                for label, run in (
+                        ('/new', lambda: post_new(db, items)),
+                        ('/batch of {}'.format(args.batch),
+                         lambda: post_batch(db, items, args.batch))):
+                    start = time.time()
+                    created.extend(run())
+                    elapsed = time.time() - start
+                    print('{:<16} {:>8.0f} entries/s  {:>8.1f}ms total'.format(
+                        label, args.count / elapsed, elapsed * 1000))
+            finally:
+                db.rollback()
+                if created:
+                    db.cursor().execute(
+                        'DELETE FROM entries WHERE id = ANY(%s)', (created, ))
+                    db.commit()
+    finally:
+        testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
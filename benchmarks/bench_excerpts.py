@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Measure memory used to build a home page of very large entries
+
+Inserts --entries entries of --size characters each inside a transaction,
+then builds the list page data twice: loading and rendering full bodies,
+as read_entries did before excerpts, and loading excerpts through the
+entries_list statement. Peak Python allocations are measured with
+tracemalloc. Nothing is committed: the inserted entries are rolled back
+when the run ends.
+
+    python benchmarks/bench_excerpts.py --dsn 'dbname=test_learning_journal'
+"""
+import argparse
+import datetime
+import os
+import sys
+import tracemalloc
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+
+FULL_LIST = """SELECT id, title, text, created, version, false FROM entries ORDER BY created DESC LIMIT 10
+"""
+
+
+def make_text(size):
+    para = 'A paragraph of notes about what was learned today. ' * 8 + '\n\n'
+    return (para * (size // len(para) + 1))[:size]
+
+
+def peak(build):
+    """return the peak bytes allocated while build runs"""
+    journal.render_cache.clear()
+    tracemalloc.start()
+    try:
+        build()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get(
+        'DATABASE_URL', 'dbname=test_learning_journal user=henryhowes'))
+    parser.add_argument('--entries', type=int, default=10)
+    parser.add_argument('--size', type=int, default=200 * 1024)
+    args = parser.parse_args()
+
+    text = make_text(args.size)
+    with closing(journal.connect_db({'db': args.dsn})) as db:
+        cursor = db.cursor()
+        cursor.execute(journal.DB_SCHEMA)
+        now = datetime.datetime.utcnow()
+        for idx in range(args.entries):
+            cursor.execute(journal.WRITE_ENTRY, (
+                'Entry {}'.format(idx), text, journal.make_excerpt(text),
+                now + datetime.timedelta(seconds=idx)))
+
+        def full():
+            cursor.execute(FULL_LIST)
+            rows = [journal.Entry._make(row) for row in cursor.fetchall()]
+            return journal.render_entries(rows, {})
+
+        def excerpts():
+            journal.execute_prepared(cursor, 'entries_list')
+            rows = [journal.Entry._make(row) for row in cursor.fetchall()]
+            return journal.render_entries(rows, {})
+
+        print('{} entries of {} characters'.format(args.entries, args.size))
+        print('full bodies: {:.1f}KB peak'.format(peak(full) / 1024.0))
+        print('excerpts:    {:.1f}KB peak'.format(peak(excerpts) / 1024.0))
+        db.rollback()
+
+
+if __name__ == '__main__':
+    main()
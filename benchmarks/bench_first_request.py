@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Time the first render of each page in a new worker, with and without
+a precompiled template bytecode cache
+
+Each round builds the app with main() against an empty cache directory
+and times its first render of the home, detail and login templates; then
+precompiles into another directory and times a second app's first render
+from it. Templates are rendered as the views render them, without a
+database.
+
+    python benchmarks/bench_first_request.py --rounds 5
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pyramid import testing
+from pyramid.renderers import render
+from pyramid.threadlocal import manager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+
+PAGES = ('templates/list2.jinja2', 'templates/detail.jinja2',
+         'templates/login.jinja2')
+
+
+def first_render(cache_dir, precompile):
+    """return seconds a new app takes to first render every page"""
+    os.environ['JINJA2_CACHE_DIR'] = cache_dir
+    if precompile:
+        journal.precompile_templates(journal.main())
+    app = journal.main()
+    now = datetime.datetime.utcnow()
+    entry = journal.Entry(1, 'Title', '<p>Text</p>', now, 1, False)
+    values = {'entries': [entry], 'entry': entry, 'error': '', 'username': ''}
+    request = testing.DummyRequest()
+    request.registry = app.registry
+    manager.push({'registry': app.registry, 'request': request})
+    try:
+        start = time.time()
+        for page in PAGES:
+            render(page, values, request=request, package=journal)
+        return time.time() - start
+    finally:
+        manager.pop()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    timings = {False: [], True: []}
+    for _ in range(args.rounds):
+        for precompile in (False, True):
+            cache_dir = tempfile.mkdtemp()
+            try:
+                timings[precompile].append(first_render(cache_dir, precompile))
+            finally:
+                shutil.rmtree(cache_dir)
+
+    cold, warm = median(timings[False]), median(timings[True])
+    print('first render, source only:  {:.1f}ms'.format(cold * 1000))
+    print('first render, precompiled:  {:.1f}ms'.format(warm * 1000))
+    print('saved per worker start:     {:.1f}ms'.format((cold - warm) * 1000))
+
+
+if __name__ == '__main__':
+    main()
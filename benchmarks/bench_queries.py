@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Compare ad hoc queries into dicts with prepared statements into Entry rows
+
+Runs the home page and detail queries the way journal.py did before
+execute_prepared (fresh SQL text each call, rows zipped into dicts) and the
+way it does now, against the database at --dsn. Reads only.
+
+    python benchmarks/bench_queries.py --dsn 'dbname=learning_journal' -n 2000
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+
+KEYS = ('id', 'title', 'text', 'created', 'version', 'truncated')
+
+
+def run_plain(db, query, params, count):
+    cursor = db.cursor()
+    start = time.time()
+    for _ in range(count):
+        cursor.execute(query, params)
+        rows = [dict(zip(KEYS, row)) for row in cursor.fetchall()]
+    return time.time() - start, rows
+
+
+def run_prepared(db, name, params, count):
+    cursor = db.cursor()
+    start = time.time()
+    for _ in range(count):
+        journal.execute_prepared(cursor, name, params)
+        rows = [journal.Entry._make(row) for row in cursor.fetchall()]
+    return time.time() - start, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get(
+        'DATABASE_URL', 'dbname=learning_journal user=henryhowes'))
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    with closing(journal.connect_db({'db': args.dsn})) as db:
+        cursor = db.cursor()
+        cursor.execute('SELECT id FROM entries LIMIT 1')
+        row = cursor.fetchone()
+        if row is None:
+            sys.exit('the entries table is empty, add some entries first')
+        cases = [
+            ('entries_list', journal.DB_ENTRIES_LIST, ()),
+            ('entry', journal.DB_ENTRY, (row[0], )),
+        ]
+        for name, query, params in cases:
+            plain, dicts = run_plain(db, query, params, args.count)
+            prepared, entries = run_prepared(db, name, params, args.count)
+            print('{}: plain {:.3f}ms prepared {:.3f}ms per query'.format(
+                name, plain * 1000 / args.count,
+                prepared * 1000 / args.count))
+            print('{}: {} bytes per dict row, {} per Entry row'.format(
+                name, sys.getsizeof(dicts[0]), sys.getsizeof(entries[0])))
+        db.rollback()
+
+
+if __name__ == '__main__':
+    main()
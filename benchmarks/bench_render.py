@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Time rendering a cold home page inline and across a process pool
+
+Builds ten code-heavy entries like the ones listed on the home page and
+renders them through journal.render_entries with an empty render_cache,
+once inline and once with a multiprocessing pool. No database is needed.
+
+    python benchmarks/bench_render.py --processes 4 --repeat 5
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+
+CODE = '''```python
+def fib(n):
+    """return the nth fibonacci number"""
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+```
+'''
+
+
+def make_entries(count, blocks):
+    now = datetime.datetime.utcnow()
+    text = 'Some notes on today.\n\n' + '\n'.join([CODE] * blocks)
+    return [journal.Entry(idx, 'Entry {}'.format(idx), text, now, 1, False)
+            for idx in range(count)]
+
+
+def time_render(entries, settings, repeat):
+    best = None
+    for _ in range(repeat):
+        # cold cache each time, as after a deploy
+        journal.render_cache.clear()
+        start = time.time()
+        journal.render_entries(entries, settings)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=10)
+    parser.add_argument('--blocks', type=int, default=8,
+                        help='code blocks per entry')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    entries = make_entries(args.entries, args.blocks)
+    inline = time_render(entries, {}, args.repeat)
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        settings = {'render.pool': pool, 'render.min_parallel': 0}
+        # start the workers before timing
+        pool.map(journal.render_markdown, ['warm up'] * args.processes)
+        pooled = time_render(entries, settings, args.repeat)
+    finally:
+        pool.terminate()
+
+    print('entries: {} x {} chars'.format(len(entries), len(entries[0].text)))
+    print('inline:  {:.1f}ms'.format(inline * 1000))
+    print('pool({}): {:.1f}ms ({:.2f}x)'.format(
+        args.processes, pooled * 1000, inline / pooled))
+
+
+if __name__ == '__main__':
+    main()
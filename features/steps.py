@@ -12,7 +12,9 @@ CREATE TABLE IF NOT EXISTS entries (
     id serial PRIMARY KEY,
     title VARCHAR (127) NOT NULL,
     text TEXT NOT NULL,
-    created TIMESTAMP NOT NULL
+    created TIMESTAMP NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    excerpt TEXT
 )
 """
 INSERT_ENTRY = """INSERT INTO entries (title, text, created) VALUES (%s, %s, %s)
@@ -1,19 +1,42 @@
 # -*- coding: utf-8 -*-
 import psycopg2
+import cProfile
 import os
 import logging
 import datetime
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import select
+import sys
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from psycopg2.extensions import connection as _connection
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from cryptacular.bcrypt import BCRYPTPasswordManager
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
 from pyramid.events import NewRequest, subscriber
 from pyramid.httpexceptions import HTTPFound, HTTPInternalServerError, HTTPForbidden
+from pyramid.httpexceptions import HTTPBadRequest, HTTPRequestEntityTooLarge
+from pyramid.response import Response
 from pyramid.security import remember, forget
 from pyramid.session import SignedCookieSessionFactory
+from pyramid.settings import asbool
 from pyramid.view import view_config
+from six import string_types
 from waitress import serve
 from contextlib import closing
+from jinja2 import meta, nodes
+from jinja2.ext import Extension
+from pyramid_jinja2 import IJinja2Environment
+from repoze.lru import LRUCache
 import markdown
 
 here = os.path.dirname(os.path.abspath(__file__))
@@ -23,99 +46,186 @@ CREATE TABLE IF NOT EXISTS entries (
     id serial PRIMARY KEY,
     title VARCHAR (127) NOT NULL,
     text TEXT NOT NULL,
-    created TIMESTAMP NOT NULL
-)
+    created TIMESTAMP NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    excerpt TEXT
+);
+ALTER TABLE entries ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE entries ADD COLUMN IF NOT EXISTS excerpt TEXT;
 """
 
 INSERT_ENTRY = """INSERT INTO entries (title, text, created) VALUES (%s, %s, %s)
 """
 
-DB_ENTRIES_LIST = """SELECT id, title, text, created FROM entries ORDER BY created DESC LIMIT 10
+WRITE_ENTRY = """INSERT INTO entries (title, text, excerpt, created) VALUES (%s, %s, %s, %s)
+RETURNING id
 """
 
-DB_ENTRY = """SELECT * FROM entries WHERE id=%s
+# long entries are listed by their excerpt, short ones have none
+DB_ENTRIES_LIST = """SELECT id, title, COALESCE(excerpt, text), created, version, excerpt IS NOT NULL FROM entries ORDER BY created DESC LIMIT 10
 """
 
-NEW_ENTRY = """SELECT * FROM entries ORDER BY created DESC LIMIT 1
+DB_ENTRY = """SELECT id, title, text, created, version, false FROM entries WHERE id=%s
 """
 
-UPDATE_ENTRY = """UPDATE entries SET title=%s, text=%s WHERE id=%s
+# the text of entries over the size limit is left to be streamed
+DB_ENTRY_HEAD = """SELECT id, title, CASE WHEN octet_length(text) > %s THEN NULL ELSE text END, created, version, octet_length(text) > %s FROM entries WHERE id=%s
 """
 
+# an entry as it is shown in the list, see DB_ENTRIES_LIST
+DB_ENTRY_SUMMARY = """SELECT id, title, COALESCE(excerpt, text), created, version, excerpt IS NOT NULL FROM entries WHERE id=%s
+"""
+
+DB_ENTRY_CHUNK = """SELECT substr(text, %s, %s) FROM entries WHERE id=%s
+"""
+
+UPDATE_ENTRY = """UPDATE entries SET title=%s, text=%s, excerpt=%s, version=version + 1 WHERE id=%s
+"""
+
+# one row of %s placeholders per entry is added to WRITE_ENTRIES
+WRITE_ENTRIES = """INSERT INTO entries (title, text, excerpt, created) VALUES {}
+RETURNING id, title, text, created, version, false
+"""
+
+# delivered to LISTENers on the entries channel when the transaction commits
+NOTIFY_ENTRY = """SELECT pg_notify('entries', %s)
+"""
+
+NOTIFY_ENTRIES = """SELECT pg_notify('entries', delta) FROM unnest(%s) AS delta
+"""
+
+DB_ALL_ENTRIES = """SELECT id, title, text, created, version, false FROM entries ORDER BY id
+"""
+
+DB_MISSING_EXCERPTS = """SELECT id, title, text, created, version, false FROM entries WHERE excerpt IS NULL AND length(text) > %s ORDER BY id
+"""
+
+SET_EXCERPT = """UPDATE entries SET excerpt=%s, version=version + 1 WHERE id=%s
+"""
+
+# statements prepared server-side once per connection, see execute_prepared
+PREPARED_STATEMENTS = {
+    'entries_list': DB_ENTRIES_LIST,
+    'entry': DB_ENTRY,
+    'entry_head': DB_ENTRY_HEAD,
+    'entry_summary': DB_ENTRY_SUMMARY,
+    'entry_chunk': DB_ENTRY_CHUNK,
+    'update_entry': UPDATE_ENTRY,
+    'insert_entry': WRITE_ENTRY,
+    'notify_entry': NOTIFY_ENTRY,
+}
+
+# truncated is set when text holds less than the whole entry: an excerpt on
+# the list page, or nothing at all for a detail page that is streamed
+Entry = namedtuple('Entry', 'id title text created version truncated')
+
+# entries longer than this many characters are listed by an excerpt
+EXCERPT_LENGTH = 1000
+
+# default byte limits for request bodies and for rendering entries whole
+MAX_BODY_BYTES = 1024 * 1024
+STREAM_BYTES = 256 * 1024
+STREAM_CHUNK = 64 * 1024
+
+# the start of a markdown list item
+LIST_ITEM = re.compile(r'([*+-]|\d+\.)\s')
+
+# the width of the entries.title column
+TITLE_LENGTH = 127
+
+# most entries accepted by one request to the batch endpoint
+MAX_BATCH = 100
+
+# characters of markdown below which rendering stays in-process; a home
+# page of ten code-heavy excerpts is enough to be worth the round trip
+MIN_PARALLEL_RENDER = 4000
+
+# seconds to wait for the render pool before rendering inline instead
+RENDER_TIMEOUT = 10
+
+# rendered markdown keyed by entry id, version and creation time, so an
+# edit (which bumps version) is never served stale
+RENDER_CACHE_SIZE = 1000
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+# rendered HTML longer than this is not cached, which bounds each cache at
+# RENDER_CACHE_SIZE * CACHE_ITEM_LENGTH characters
+CACHE_ITEM_LENGTH = 16 * 1024
+
 logging.basicConfig()
 log = logging.getLogger(__file__)
 
 
 @view_config(route_name='home', renderer='templates/list2.jinja2')
 def read_entries(request):
-    """return a list of all entries as dicts"""
+    """return a list of the most recent entries"""
     cursor = request.db.cursor()
-    cursor.execute(DB_ENTRIES_LIST)
-    keys = ('id', 'title', 'text', 'created')
-    entries = [dict(zip(keys, row)) for row in cursor.fetchall()]
-    for item in entries:
-        item['text'] = markdown.markdown(
-            item['text'], extensions=['codehilite', 'fenced_code'])
-    return {'entries': entries}
+    execute_prepared(cursor, 'entries_list')
+    entries = [Entry._make(row) for row in cursor.fetchall()]
+    settings = request.registry.settings or {}
+    return {'entries': render_entries(entries, settings)}
 
 
 @view_config(route_name='detail', renderer='templates/detail.jinja2')
 def read_entry(request):
-    """return a list of all entries as dicts"""
-    cursor = request.db.cursor()
-    cursor.execute(DB_ENTRY, (request.matchdict['id'], ))
-    keys = ('id', 'title', 'text', 'created')
-    row = cursor.fetchone()
-    entry = dict(zip(keys, row))
-    entry['text'] = markdown.markdown(
-        entry['text'], extensions=['codehilite', 'fenced_code'])
-    return {'entry': entry}
+    """return a single entry
+
+    Entries over entries.stream_bytes are not loaded whole; the page is
+    streamed, rendering the body a markdown block at a time.
+    """
+    settings = request.registry.settings or {}
+    limit = int(settings.get('entries.stream_bytes', STREAM_BYTES))
+    entry = fetch_entry(
+        request.db, 'entry_head', limit, limit, request.matchdict['id'])
+    if not entry.truncated:
+        return {'entry': render_entry(entry)}
+
+    dsn = getattr(request, 'db_dsn', settings.get('db'))
+    entry = entry._replace(text=iter_entry_html(settings, dsn, entry.id))
+    env = request.registry.getUtility(IJinja2Environment, name='.jinja2')
+    template = env.get_template('{}:templates/detail.jinja2'.format(__name__))
+    chunks = template.generate(entry=entry, request=request)
+    return Response(app_iter=(chunk.encode('utf-8') for chunk in chunks),
+                    content_type='text/html', charset='utf-8')
 
 
 @view_config(route_name='edit', renderer='json')
 def edit_entry_view(request):
-    """return a list of all entries as dicts"""
+    """return a single entry as a dict for editing or after an edit"""
     if request.authenticated_userid:
         if request.method == 'GET':
-            # import pdb; pdb.set_trace();
-            cursor = request.db.cursor()
-            cursor.execute(DB_ENTRY, (request.params.get('id', None), ))
-            keys = ('id', 'title', 'text', 'created')
-            row = cursor.fetchone()
-            entry = dict(zip(keys, row))
-            entry['created'] = entry['created'].strftime('%b %d, %Y')
-
-            return entry
+            entry = fetch_entry(
+                request.db, 'entry', request.params.get('id', None))
+            entry = entry._replace(created=entry.created.strftime('%b %d, %Y'))
+            return entry._asdict()
 
         elif request.method == 'POST':
-            # import pdb; pdb.set_trace()
             try:
                 edit_entry(request)
             except psycopg2.Error:
                 # this will catch any errors generated by the database
                 return HTTPInternalServerError()
 
-            cursor = request.db.cursor()
-            cursor.execute(DB_ENTRY, (request.params.get('id', None), ))
-            keys = ('id', 'title', 'text', 'created')
-            # import pdb; pdb.set_trace()
-            row = cursor.fetchone()
-            entry = dict(zip(keys, row))
-
-            entry['text'] = markdown.markdown(
-                entry['text'], extensions=['codehilite', 'fenced_code'])
-            entry['created'] = entry['created'].strftime('%b %d, %Y')
-            return entry
+            entry = fetch_entry(
+                request.db, 'entry', request.params.get('id', None))
+            entry = render_entry(entry)
+            entry = entry._replace(created=entry.created.strftime('%b %d, %Y'))
+            return entry._asdict()
     else:
         return HTTPForbidden()
 
 
 def write_entry(request):
-    """write a single entry to the database"""
+    """write a single entry to the database and return its id"""
     title = request.params.get('title', None)
     text = request.params.get('text', None)
     created = datetime.datetime.utcnow()
-    request.db.cursor().execute(INSERT_ENTRY, [title, text, created])
+    cursor = request.db.cursor()
+    execute_prepared(cursor, 'insert_entry',
+                     [title, text, make_excerpt(text), created])
+    id = cursor.fetchone()[0]
+    notify_entry(cursor, 'new', id)
+    return id
 
 
 def edit_entry(request):
@@ -123,7 +233,16 @@ def edit_entry(request):
     title = request.params.get('title', None)
     text = request.params.get('text', None)
     id = request.params.get('id', None)
-    request.db.cursor().execute(UPDATE_ENTRY, [title, text, id])
+    cursor = request.db.cursor()
+    execute_prepared(cursor, 'update_entry',
+                     [title, text, make_excerpt(text), id])
+    notify_entry(cursor, 'edit', id)
+
+
+def notify_entry(cursor, op, id):
+    """tell the change feed an entry changed, once the transaction commits"""
+    delta = json.dumps({'op': op, 'id': int(id)})
+    execute_prepared(cursor, 'notify_entry', [delta])
 
 
 @view_config(route_name='new', renderer='json')
@@ -131,24 +250,318 @@ def add_entry(request):
     if request.authenticated_userid:
         if request.method == 'POST':
             try:
-                write_entry(request)
+                id = write_entry(request)
             except psycopg2.Error:
                 # this will catch any errors generated by the database
                 return HTTPInternalServerError
 
-            cursor = request.db.cursor()
-            cursor.execute(NEW_ENTRY)
-            keys = ('id', 'title', 'text', 'created')
-            row = cursor.fetchone()
-            entry = dict(zip(keys, row))
-            entry['text'] = markdown.markdown(
-                entry['text'], extensions=['codehilite', 'fenced_code'])
-            entry['created'] = entry['created'].strftime('%b %d, %Y')
-            return entry
+            # listed like any other entry, by its excerpt if it has one
+            entry = render_entry(fetch_entry(request.db, 'entry_summary', id))
+            entry = entry._replace(created=entry.created.strftime('%b %d, %Y'))
+            return entry._asdict()
     else:
         return HTTPForbidden
 
 
+@view_config(route_name='batch', renderer='json', request_method='POST')
+def add_entries(request):
+    """create every entry in a JSON list of {title, text} objects
+
+    All the entries are written by one multi-row INSERT and returned
+    rendered, in the order they were given.
+    """
+    if not request.authenticated_userid:
+        return HTTPForbidden()
+    try:
+        entries = write_entries(request)
+    except ValueError as e:
+        return HTTPBadRequest(str(e))
+    except psycopg2.Error:
+        # this will catch any errors generated by the database
+        return HTTPInternalServerError()
+
+    settings = request.registry.settings
+    result = []
+    for entry in render_entries(entries, settings):
+        entry = entry._replace(created=entry.created.strftime('%b %d, %Y'))
+        result.append(entry._asdict())
+    return {'entries': result}
+
+
+def write_entries(request):
+    """write the entries in a JSON request body and return them
+
+    Raises ValueError if the body is not a list of entries with a string
+    title of at most TITLE_LENGTH characters and a string text, or holds
+    more than entries.max_batch of them.
+    """
+    try:
+        items = request.json_body
+    except ValueError:
+        raise ValueError('body must be JSON')
+    settings = request.registry.settings or {}
+    limit = int(settings.get('entries.max_batch', MAX_BATCH))
+    if not isinstance(items, list) or not 0 < len(items) <= limit:
+        raise ValueError('body must be a list of 1 to {} entries'.format(limit))
+    now = datetime.datetime.utcnow()
+    rows = []
+    for idx, item in enumerate(items):
+        if not (isinstance(item, dict) and item.get('title') and
+                item.get('text')):
+            raise ValueError('every entry needs a title and text')
+        if not (isinstance(item['title'], string_types) and
+                isinstance(item['text'], string_types)):
+            raise ValueError('title and text must be strings')
+        if len(item['title']) > TITLE_LENGTH:
+            raise ValueError(
+                'titles must be at most {} characters'.format(TITLE_LENGTH))
+        # keep the batch in the order given when listed newest first
+        created = now + datetime.timedelta(microseconds=idx)
+        rows.append((item['title'], item['text'],
+                     make_excerpt(item['text']), created))
+
+    cursor = request.db.cursor()
+    values = ', '.join(
+        cursor.mogrify('(%s, %s, %s, %s)', row).decode('utf-8')
+        for row in rows)
+    cursor.execute(WRITE_ENTRIES.format(values))
+    entries = [Entry._make(row) for row in cursor.fetchall()]
+    cursor.execute(NOTIFY_ENTRIES, (
+        [json.dumps({'op': 'new', 'id': entry.id}) for entry in entries], ))
+    return entries
+
+
+@view_config(route_name='changes', renderer='json')
+def read_changes(request):
+    """long-poll for entries created or edited after the given cursor
+
+    Without a cursor the current one is returned straight away; clients
+    then pass back the cursor from each response to wait for the next
+    change. Each waiting request holds a server thread, so once
+    changes.max_waiting are waiting the rest are answered at once with
+    busy set, and clients back off before polling again.
+    """
+    settings = request.registry.settings
+    feed = get_change_feed(settings)
+    since = request.params.get('cursor')
+    if not since:
+        return {'cursor': feed.cursor, 'entries': [], 'busy': False}
+    try:
+        since = int(since)
+    except ValueError:
+        return HTTPBadRequest('cursor must be an integer')
+    cursor, deltas, busy = feed.wait(
+        since, float(settings['changes.timeout']),
+        int(settings['changes.max_waiting']))
+    # replicas may not have the change yet, the primary always does
+    request.use_primary = True
+    ids = sorted(set(delta['id'] for delta in deltas))
+    entries = [fetch_entry(request.db, 'entry_summary', id) for id in ids]
+    result = []
+    for entry in render_entries(entries, settings):
+        entry = entry._replace(created=entry.created.strftime('%b %d, %Y'))
+        result.append(entry._asdict())
+    return {'cursor': cursor, 'entries': result, 'busy': busy}
+
+
+def render_markdown(text):
+    """return text rendered from markdown to HTML"""
+    return markdown.markdown(text, extensions=['codehilite', 'fenced_code'])
+
+
+def render_entry(entry):
+    """return a copy of entry with its text rendered from markdown"""
+    return render_entries([entry], {})[0]
+
+
+def render_entries(entries, settings):
+    """return copies of entries with their text rendered from markdown
+
+    Entries in render_cache are served from it. The rest are rendered in
+    the render.pool processes when there is enough text to be worth
+    shipping to them, and inline otherwise or if the pool fails to answer
+    within render.timeout seconds.
+    """
+    keys = [(entry.id, entry.version, entry.created, entry.truncated)
+            for entry in entries]
+    html = [render_cache.get(key) for key in keys]
+    missing = [idx for idx, value in enumerate(html) if value is None]
+    texts = [entries[idx].text for idx in missing]
+    pool = settings.get('render.pool')
+    threshold = int(settings.get('render.min_parallel', MIN_PARALLEL_RENDER))
+    parallel = (pool is not None and len(texts) > 1 and
+                sum(len(text) for text in texts) >= threshold)
+    rendered = None
+    if parallel:
+        timeout = float(settings.get('render.timeout', RENDER_TIMEOUT))
+        try:
+            rendered = pool.map_async(render_markdown, texts).get(timeout)
+        except Exception:
+            log.exception('render pool failed, rendering inline')
+    if rendered is None:
+        rendered = [render_markdown(text) for text in texts]
+    for idx, value in zip(missing, rendered):
+        if len(value) <= CACHE_ITEM_LENGTH:
+            render_cache.put(keys[idx], value)
+        html[idx] = value
+    return [entry._replace(text=value) for entry, value in zip(entries, html)]
+
+
+def iter_lines(chunks):
+    """yield the lines in an iterable of text chunks, without newlines"""
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    yield pending
+
+
+def iter_blocks(chunks):
+    """yield the markdown blocks in an iterable of text chunks
+
+    A block ends at a blank line outside fenced code that is followed by a
+    line which is neither indented nor a list item, so list items and
+    their continuation paragraphs stay together. Each block can then be
+    rendered on its own with only one held in memory at a time.
+    """
+    block = []
+    fenced = False
+    blank = False
+    for line in iter_lines(chunks):
+        if (blank and line.strip() and not line[0].isspace() and
+                not LIST_ITEM.match(line)):
+            if ''.join(block).strip():
+                yield '\n'.join(block) + '\n'
+            block = []
+        block.append(line)
+        if line.lstrip().startswith(('```', '~~~')):
+            fenced = not fenced
+            blank = False
+        else:
+            blank = not fenced and not line.strip()
+    if ''.join(block).strip():
+        yield '\n'.join(block)
+
+
+def make_excerpt(text):
+    """return the opening blocks of text to list the entry by
+
+    Returns None when the text is short enough to be listed whole.
+    """
+    if text is None or len(text) <= EXCERPT_LENGTH:
+        return None
+    excerpt = ''
+    for block in iter_blocks([text]):
+        if excerpt and len(excerpt) + len(block) > EXCERPT_LENGTH:
+            break
+        excerpt += block
+    if len(excerpt) > EXCERPT_LENGTH:
+        # a single long opening block, cut it and close any open fence
+        excerpt = excerpt[:EXCERPT_LENGTH]
+        fence = None
+        for line in excerpt.split('\n'):
+            marker = line.lstrip()[:3]
+            if marker in ('```', '~~~'):
+                if fence is None:
+                    fence = marker
+                elif marker == fence:
+                    fence = None
+        if fence is not None:
+            excerpt += '\n{}\n'.format(fence)
+    return excerpt
+
+
+def iter_entry_html(settings, dsn, id, chunk_size=STREAM_CHUNK):
+    """yield the rendered body of an entry a block at a time
+
+    The text is read in chunk_size slices over a connection taken from the
+    pool for dsn, as the request's own connection is released before the
+    response body is sent. Since blocks are rendered separately,
+    reference-style links only resolve within their own block.
+    """
+    pools = settings.get('db.pools')
+    db = checkout(pools[dsn]) if pools else connect_db({'db': dsn})
+    broken = False
+    try:
+        # read every slice from one snapshot of the entry
+        db.rollback()
+        cursor = db.cursor()
+        cursor.execute(
+            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+        def chunks():
+            start = 1
+            while True:
+                execute_prepared(cursor, 'entry_chunk', [start, chunk_size, id])
+                chunk = cursor.fetchone()[0]
+                if not chunk:
+                    return
+                yield chunk
+                start += chunk_size
+
+        for block in iter_blocks(chunks()):
+            yield render_markdown(block)
+        db.rollback()
+    except psycopg2.Error:
+        broken = True
+        raise
+    finally:
+        if pools:
+            pools[dsn].putconn(db, close=broken)
+        else:
+            db.close()
+
+
+def backfill_excerpts(settings):
+    """store excerpts for long entries written before excerpts existed
+
+    Returns the number of entries updated.
+    """
+    count = 0
+    with closing(connect_db(settings)) as db:
+        cursor = db.cursor()
+        for entry in iter_entries(db, DB_MISSING_EXCERPTS, (EXCERPT_LENGTH,)):
+            cursor.execute(SET_EXCERPT, (make_excerpt(entry.text), entry.id))
+            count += 1
+        db.commit()
+    return count
+
+
+class FragmentCacheExtension(Extension):
+    """Add a {% cache key, ... %}...{% endcache %} tag to templates
+
+    The rendered body, unless longer than CACHE_ITEM_LENGTH, is kept in an
+    LRU cache on the environment under the tuple of key expressions, so
+    include whatever makes the fragment change (e.g. entry.id,
+    entry.version) and keep anything per-user outside the block.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache(RENDER_CACHE_SIZE))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cache_support', [nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, caller):
+        key = tuple(key)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            if len(fragment) <= CACHE_ITEM_LENGTH:
+                self.environment.fragment_cache.put(key, fragment)
+        return fragment
+
+
 @view_config(route_name='login', renderer="templates/login.jinja2")
 def login(request):
     username = request.params.get('username', '')
@@ -177,15 +590,158 @@ def logout(request):
                      headers=headers)
 
 
+class JournalConnection(_connection):
+    """A psycopg2 connection that remembers its prepared statements
+
+    PREPARE is not undone by ROLLBACK: a prepared statement lasts for the
+    whole database session, so the set is kept for the connection's life.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(JournalConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
 def connect_db(settings):
     """Return a connection to the configured database"""
-    return psycopg2.connect(settings['db'])
+    return psycopg2.connect(settings['db'],
+                            connection_factory=JournalConnection)
+
+
+def create_pool(settings, dsn):
+    """Return a pool of connections to the database at dsn
+
+    No connection is opened until one is asked for, so an unreachable
+    replica does not stop the app from starting.
+    """
+    return ThreadedConnectionPool(
+        0, int(settings.get('db.pool_size', 10)), dsn,
+        connection_factory=JournalConnection)
+
+
+def candidate_dsns(request):
+    """return the DSNs to try, in order, for this request's connection
+
+    Reads are spread round-robin over the replicas not recently found to
+    be down, with the primary as the last resort. Writes, and reads made
+    within db.pin_seconds of the same client's last write, go straight to
+    the primary so that users always see their own changes.
+    """
+    settings = request.registry.settings
+    primary = settings['db']
+    replicas = settings.get('db.replicas')
+    if not replicas or request.method not in ('GET', 'HEAD'):
+        return [primary]
+    if getattr(request, 'use_primary', False):
+        return [primary]
+    if request.session.get('db.pinned_until', 0) > time.time():
+        return [primary]
+    start = next(settings['db.replica_counter']) % len(replicas)
+    now = time.time()
+    down = settings['db.replicas_down']
+    healthy = [dsn for dsn in replicas[start:] + replicas[:start]
+               if down.get(dsn, 0) <= now]
+    return healthy + [primary]
+
+
+def connect_request_db(request):
+    """return a (dsn, connection) pair for this request
+
+    A replica that cannot be reached is skipped for db.replica_retry
+    seconds and the next candidate is tried, as is a replica whose pool is
+    exhausted; failing to reach the primary is an error.
+    """
+    settings = request.registry.settings
+    for dsn in candidate_dsns(request):
+        try:
+            return dsn, checkout(settings['db.pools'][dsn])
+        except PoolError:
+            if dsn == settings['db']:
+                raise
+            log.warning('replica pool exhausted, failing over: %s', dsn)
+        except psycopg2.OperationalError:
+            if dsn == settings['db']:
+                raise
+            log.warning('replica unavailable, failing over: %s', dsn)
+            settings['db.replicas_down'][dsn] = (
+                time.time() + float(settings['db.replica_retry']))
+
+
+def checkout(pool):
+    """return a connection from pool that answers a trivial query
+
+    Pooled connections whose server has gone away, as all idle ones have
+    after a database restart, are discarded until the pool hands out one
+    that works or opens a new one. Raises OperationalError if even a new
+    connection fails.
+    """
+    # the pool holds at most maxconn connections, so one more attempt is
+    # certain to open a fresh one
+    for attempt in range(pool.maxconn + 1):
+        db = pool.getconn()
+        try:
+            db.cursor().execute('SELECT 1')
+            return db
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pool.putconn(db, close=True)
+    raise psycopg2.OperationalError('no live connection in pool')
+
+
+def execute_prepared(cursor, name, params=()):
+    """execute one of PREPARED_STATEMENTS by name on the given cursor
+
+    The statement is sent to the server to be parsed and planned the first
+    time it is used on a connection; after that only its name and
+    parameters travel over the wire. Raises ValueError if params does not
+    match the statement's placeholders.
+    """
+    statement = PREPARED_STATEMENTS[name]
+    expected = statement.count('%s')
+    if len(params) != expected:
+        raise ValueError('{} takes {} parameters, {} given'.format(
+            name, expected, len(params)))
+    db = cursor.connection
+    if name not in db.prepared:
+        count = iter(range(1, expected + 1))
+        query = re.sub('%s', lambda m: '${}'.format(next(count)), statement)
+        cursor.execute('PREPARE {} AS {}'.format(name, query))
+        db.prepared.add(name)
+    if params:
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute('EXECUTE {} ({})'.format(name, placeholders), params)
+    else:
+        cursor.execute('EXECUTE {}'.format(name))
+
+
+def fetch_entry(db, name, *params):
+    """return the single Entry selected by a prepared statement"""
+    cursor = db.cursor()
+    execute_prepared(cursor, name, params)
+    return Entry._make(cursor.fetchone())
+
+
+def iter_entries(db, query=DB_ALL_ENTRIES, params=(), itersize=100):
+    """yield Entry rows from a server-side cursor
+
+    Only itersize rows are held in memory at a time, so this is the way to
+    walk result sets too large to fetchall.
+    """
+    cursor = db.cursor(name='entries_{}'.format(uuid.uuid4().hex))
+    cursor.itersize = itersize
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield Entry._make(row)
+    finally:
+        cursor.close()
 
 
 def init_db():
     """Create database tables defined by DB_SCHEMA
 
-    Warning: This function will not update existing table definitions
+    Existing tables keep their data; columns added since they were created
+    (version, excerpt) are added to them. Other changes to existing
+    column definitions are not applied.
     """
     settings = {}
     settings['db'] = os.environ.get(
@@ -196,12 +752,39 @@ def init_db():
         db.commit()
 
 
+def open_connection(request):
+    """return a database connection for this request
+
+    Installed as the reified request.db, so the connection is only taken
+    from the pool when a view first uses it; static files and waiting
+    long-polls do not hold one.
+    """
+    settings = request.registry.settings
+    if settings.get('db.pools'):
+        request.db_dsn, db = connect_request_db(request)
+    else:
+        db = connect_db(settings)
+    request.add_finished_callback(close_connection)
+    return db
+
+
+@subscriber(NewRequest)
+def limit_request_body(event):
+    """refuse request bodies over entries.max_body bytes unread"""
+    request = event.request
+    limit = request.registry.settings.get('entries.max_body')
+    if limit and (request.content_length or 0) > int(limit):
+        raise HTTPRequestEntityTooLarge()
+
+
 @subscriber(NewRequest)
-def open_connection(event):
+def pin_to_primary(event):
+    """keep a client that writes reading from the primary for a while"""
     request = event.request
     settings = request.registry.settings
-    request.db = connect_db(settings)
-    request.add_finished_callback(close_connection)
+    if settings.get('db.replicas') and request.method not in ('GET', 'HEAD'):
+        request.session['db.pinned_until'] = (
+            time.time() + float(settings['db.pin_seconds']))
 
 
 def close_connection(request):
@@ -212,11 +795,158 @@ def close_connection(request):
     """
     db = getattr(request, 'db', None)
     if db is not None:
-        if request.exception is not None:
-            db.rollback()
-        else:
-            db.commit()
-        request.db.close()
+        failed = True
+        try:
+            if request.exception is not None:
+                db.rollback()
+            else:
+                db.commit()
+            failed = False
+        finally:
+            # always hand the connection back, discarding it if it broke
+            pools = request.registry.settings.get('db.pools')
+            if pools:
+                pools[request.db_dsn].putconn(db, close=failed)
+            else:
+                db.close()
+
+
+class ChangeFeed(object):
+    """Relay entry notifications from PostgreSQL to waiting requests
+
+    A daemon thread LISTENs on its own connection to the primary and
+    appends each notification to a short in-memory log, numbered by a
+    cursor. Long-poll requests wait on a condition until the log moves
+    past the cursor they already have.
+    """
+
+    def __init__(self, dsn, size=100):
+        self.dsn = dsn
+        self.events = deque(maxlen=size)
+        self.cursor = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.listen)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                with closing(psycopg2.connect(self.dsn)) as db:
+                    db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                    db.cursor().execute('LISTEN entries')
+                    while True:
+                        if select.select([db], [], [], 60) == ([], [], []):
+                            continue
+                        db.poll()
+                        while db.notifies:
+                            notify = db.notifies.pop(0)
+                            self.publish(json.loads(notify.payload))
+            except psycopg2.Error:
+                log.exception('change feed lost its connection')
+                time.sleep(5)
+
+    def publish(self, delta):
+        with self.condition:
+            self.cursor += 1
+            self.events.append((self.cursor, delta))
+            self.condition.notify_all()
+
+    def wait(self, since, timeout, max_waiting=None):
+        """return the cursor, the deltas after since and whether it was busy
+
+        Blocks for up to timeout seconds if nothing has happened yet, unless
+        max_waiting requests are already blocked, in which case it returns
+        at once and reports busy. A cursor from before a restart is treated
+        as the current one.
+        """
+        with self.condition:
+            since = min(since, self.cursor)
+            busy = False
+            if since == self.cursor:
+                if max_waiting is not None and self.waiting >= max_waiting:
+                    busy = True
+                else:
+                    self.waiting += 1
+                    try:
+                        self.condition.wait(timeout)
+                    finally:
+                        self.waiting -= 1
+            deltas = [delta for seq, delta in self.events if seq > since]
+            return self.cursor, deltas, busy
+
+
+_change_feed_lock = threading.Lock()
+
+
+def get_change_feed(settings):
+    """return the app's ChangeFeed, starting it on first use"""
+    with _change_feed_lock:
+        if settings.get('changes.feed') is None:
+            settings['changes.feed'] = ChangeFeed(settings['db'])
+            settings['changes.feed'].start()
+    return settings['changes.feed']
+
+
+def profile_tween_factory(handler, registry):
+    """profile a sample of requests into profile.directory
+
+    A request is profiled when it carries the profile.header header set to
+    profile.token, or at random at profile.sample_rate; every other request
+    costs one call to random(). Each profile is written as a pstats file
+    (readable by pstats, snakeviz or flameprof) with a JSON file of the
+    route, matchdict and timing next to it.
+    """
+    settings = registry.settings
+    if not asbool(settings.get('profile.enabled')):
+        return handler
+    rate = float(settings.get('profile.sample_rate', 0))
+    header = settings.get('profile.header', 'X-Journal-Profile')
+    token = settings.get('profile.token')
+    directory = settings['profile.directory']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def run(request):
+        response = handler(request)
+        # render streamed bodies while the profiler is still running
+        response.body
+        return response
+
+    def profile_tween(request):
+        requested = token and request.headers.get(header) == token
+        if not requested and random.random() >= rate:
+            return handler(request)
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(run, request)
+        finally:
+            elapsed = time.time() - start
+            route = getattr(request, 'matched_route', None)
+            matchdict = getattr(request, 'matchdict', None) or {}
+            name = '{}-{}-{}-{}'.format(
+                time.strftime('%Y%m%dT%H%M%S'),
+                route.name if route else 'none',
+                matchdict.get('id', ''),
+                uuid.uuid4().hex[:8])
+            path = os.path.join(directory, name)
+            profiler.dump_stats(path + '.pstats')
+            with open(path + '.json', 'w') as meta:
+                json.dump({
+                    'route': route.name if route else None,
+                    'matchdict': matchdict,
+                    'method': request.method,
+                    'path': request.path,
+                    'elapsed': elapsed,
+                    'requested': bool(requested),
+                }, meta)
+
+    return profile_tween
 
 
 def do_login(request):
@@ -235,11 +965,66 @@ def do_login(request):
 def main():
     """Create a configured wsgi app"""
     settings = {}
-    settings['reload_all'] = os.environ.get('DEBUG', True)
-    settings['debug_all'] = os.environ.get('DEBUG', True)
+    # template auto-reload re-stats every template on each render, so it is
+    # only switched on for development
+    settings['reload_all'] = asbool(os.environ.get('DEBUG', False))
+    settings['debug_all'] = asbool(os.environ.get('DEBUG', False))
+    settings['jinja2.bytecode_caching'] = True
+    settings['jinja2.bytecode_caching_directory'] = os.environ.get(
+        'JINJA2_CACHE_DIR', os.path.join(here, '.jinja2_cache'))
+    if not os.path.isdir(settings['jinja2.bytecode_caching_directory']):
+        os.makedirs(settings['jinja2.bytecode_caching_directory'])
     settings['db'] = os.environ.get(
         'DATABASE_URL', 'dbname=learning_journal user=henryhowes'
     )
+    settings['web.threads'] = int(os.environ.get('WEB_THREADS', 16))
+    # getconn raises rather than blocks when a pool is empty, so every
+    # server thread needs a connection, plus one for the second connection
+    # a profiled, streamed detail page holds
+    settings['db.pool_size'] = max(
+        int(os.environ.get('DATABASE_POOL_SIZE', 0)),
+        settings['web.threads'] + 1)
+    # comma separated DSNs of read replicas, GET requests are routed there
+    settings['db.replicas'] = [
+        dsn.strip() for dsn in
+        os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+    settings['db.pin_seconds'] = os.environ.get('DATABASE_PIN_SECONDS', 5)
+    settings['db.replica_retry'] = os.environ.get('DATABASE_REPLICA_RETRY', 30)
+    settings['db.replica_counter'] = itertools.count()
+    settings['db.replicas_down'] = {}
+    settings['db.pools'] = dict(
+        (dsn, create_pool(settings, dsn))
+        for dsn in [settings['db']] + settings['db.replicas'])
+    settings['entries.max_body'] = os.environ.get(
+        'JOURNAL_MAX_BODY', MAX_BODY_BYTES)
+    settings['entries.stream_bytes'] = os.environ.get(
+        'JOURNAL_STREAM_BYTES', STREAM_BYTES)
+    # opt-in request profiling, see profile_tween_factory
+    settings['profile.enabled'] = asbool(os.environ.get('JOURNAL_PROFILE', False))
+    settings['profile.sample_rate'] = os.environ.get(
+        'JOURNAL_PROFILE_RATE', 0.001)
+    settings['profile.token'] = os.environ.get('JOURNAL_PROFILE_TOKEN')
+    settings['profile.directory'] = os.environ.get(
+        'JOURNAL_PROFILE_DIR', os.path.join(here, 'profiles'))
+    settings['entries.max_batch'] = os.environ.get(
+        'JOURNAL_MAX_BATCH', MAX_BATCH)
+    # processes to render markdown in, 0 renders in the request's thread
+    settings['render.processes'] = int(
+        os.environ.get('JOURNAL_RENDER_PROCESSES', 0))
+    settings['render.min_parallel'] = os.environ.get(
+        'JOURNAL_MIN_PARALLEL_RENDER', MIN_PARALLEL_RENDER)
+    settings['render.timeout'] = os.environ.get(
+        'JOURNAL_RENDER_TIMEOUT', RENDER_TIMEOUT)
+    # forked here, before the server starts any threads
+    settings['render.pool'] = None
+    if settings['render.processes']:
+        settings['render.pool'] = multiprocessing.Pool(
+            settings['render.processes'])
+    # seconds a long-poll on /changes waits for a new or edited entry, and
+    # how many may wait at once; keep the latter well under web.threads
+    settings['changes.timeout'] = os.environ.get('CHANGES_TIMEOUT', 10)
+    settings['changes.max_waiting'] = os.environ.get(
+        'CHANGES_MAX_WAITING', 8)
     settings['auth.username'] = os.environ.get('AUTH_USERNAME', 'admin')
     manager = BCRYPTPasswordManager()
     settings['auth.password'] = os.environ.get(
@@ -260,6 +1045,9 @@ def main():
         authorization_policy=ACLAuthorizationPolicy(),
     )
     config.include('pyramid_jinja2')
+    config.add_jinja2_extension(FragmentCacheExtension)
+    config.add_request_method(open_connection, 'db', reify=True)
+    config.add_tween('{}.profile_tween_factory'.format(__name__))
     config.add_static_view('static', os.path.join(here, 'static'))
     config.add_route('home', '/')
     config.add_route('new', '/new')
@@ -267,12 +1055,56 @@ def main():
     config.add_route('logout', '/logout')
     config.add_route('detail', '/detail/{id}')
     config.add_route('edit', '/edit')
+    config.add_route('changes', '/changes')
+    config.add_route('batch', '/api/entries/batch')
     config.scan()
     app = config.make_wsgi_app()
     return app
 
 
+def precompile_templates(app):
+    """compile every template into the bytecode cache
+
+    Run before starting workers (python journal.py precompile) so that the
+    first request each worker serves loads compiled bytecode rather than
+    parsing template source. Templates a template extends or includes are
+    loaded relative to it, as they are when rendered, since that is the
+    name their bytecode is cached under. Returns the names loaded.
+    """
+    env = app.registry.getUtility(IJinja2Environment, name='.jinja2')
+    pending = sorted(
+        '{}:templates/{}'.format(__name__, name)
+        for name in os.listdir(os.path.join(here, 'templates'))
+        if name.endswith('.jinja2'))
+    loaded = []
+    while pending:
+        name, parent = pending.pop(0), None
+        if isinstance(name, tuple):
+            name, parent = name
+        template = env.get_template(name, parent=parent)
+        loaded.append(template.name)
+        source = env.loader.get_source(env, template.name)[0]
+        for ref in meta.find_referenced_templates(env.parse(source)):
+            if ref is not None:
+                pending.append((ref, template.name))
+    return loaded
+
+
 if __name__ == '__main__':
     app = main()
-    port = os.environ.get('PORT', 5000)
-    serve(app, host='0.0.0.0', port=port)
+    if sys.argv[1:] == ['precompile']:
+        start = time.time()
+        names = precompile_templates(app)
+        print('compiled {} templates in {:.1f}ms'.format(
+            len(names), (time.time() - start) * 1000))
+    elif sys.argv[1:] == ['backfill']:
+        print('backfilled {} excerpts'.format(
+            backfill_excerpts(app.registry.settings)))
+    else:
+        port = os.environ.get('PORT', 5000)
+        settings = app.registry.settings
+        # waitress refuses oversized bodies before buffering them, and needs
+        # threads to spare beyond those held by waiting /changes requests
+        serve(app, host='0.0.0.0', port=port,
+              threads=int(settings['web.threads']),
+              max_request_body_size=int(settings['entries.max_body']))
@@ -1,8 +1,18 @@
+var entry_template = '<article class="entry" id="entry{{id}}">'+
+                       '<h3 class="entryTitle"><a href= "/detail/{{id}}">{{title}}</a></h3>'+
+                       '<p class="dateline">{{created}}'+
+                       '<div class="entry_body">{{{text}}}</div>'+
+                       '{{#truncated}}<p><a href="/detail/{{id}}">Continue reading</a></p>{{/truncated}}'+
+                     '</article>';
+
 $(document).ready(function () {
   $('.add_entry').on('submit', function(event){
       event.preventDefault();
       add_post();
     });
+  if ($('#entriesTitle').length) {
+      poll_changes();
+  }
 });
 
 
@@ -43,27 +53,46 @@ function edit_post() {
     });
 }
 
-function success(entry){
-    $('.add_entry').trigger('reset');
+function poll_changes(cursor) {
+    $.ajax({
+      url: '/changes',
+      type: 'GET',
+      dataType: 'json',
+      data: cursor === undefined ? {} : {'cursor': cursor},
+      success: function(changes){
+          $.each(changes.entries, function(index, entry){
+              show_change(entry);
+          });
+          if (changes.busy) {
+              // the server has no room for another waiting poll just now
+              setTimeout(function(){ poll_changes(changes.cursor); }, 10000);
+          } else {
+              poll_changes(changes.cursor);
+          }
+      },
+      error: function(){
+          setTimeout(function(){ poll_changes(cursor); }, 5000);
+      }
+    });
+}
 
-    var template = '<article class="entry" id="entry{{id}}">'+
-                      '<h3 class="entryTitle"><a href= "/detail/{{id}}">{{title}}</a></h3>'+
-                      '<p class="dateline">{{created}}'+
-                      '<div class="entry_body">{{{text}}}</div>'+
-                    '</article>';
+function show_change(entry){
+    var html = Mustache.to_html(entry_template, entry);
+    var existing = $('#entry' + entry.id);
+    if (existing.length) {
+        existing.replaceWith(html);
+    } else {
+        $('#entriesTitle').after(html);
+    }
+}
 
-    var html = Mustache.to_html(template, entry);
-    $('#entriesTitle').after(html);
+function success(entry){
+    $('.add_entry').trigger('reset');
+    show_change(entry);
 }
 
 function edit_success(entry){
-    var template = '<article class="entry" id="entry{{id}}">'+
-                      '<h3 class="entryTitle"><a href= "/detail/{{id}}">{{title}}</a></h3>'+
-                      '<p class="dateline">{{created}}'+
-                      '<div class="entry_body">{{{text}}}</div>'+
-                    '</article>';
-
-    var html = Mustache.to_html(template, entry);
+    var html = Mustache.to_html(entry_template, entry);
     $('#entryContent').html(html);
     $('#editTwitter').toggle();
 }
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from contextlib import closing
 from pyramid import testing
+import mock
+import psycopg2
 import pytest
 from journal import connect_db
 from journal import DB_SCHEMA
 import datetime
+import itertools
+import time
 from journal import INSERT_ENTRY
 import os
+import re
 from cryptacular.bcrypt import BCRYPTPasswordManager
 from webtest import AppError
 
@@ -170,10 +175,10 @@ def test_read_entries(req_context):
     assert 'entries' in result
     assert len(result['entries']) == 1
     for entry in result['entries']:
-        assert expected[0] == entry['title']
-        assert '<p>{}</p>'.format(expected[1]) == entry['text']
+        assert expected[0] == entry.title
+        assert '<p>{}</p>'.format(expected[1]) == entry.text
         for key in 'id', 'created':
-            assert key in entry
+            assert key in entry._fields
 
 
 def test_read_entry(req_context):
@@ -188,12 +193,12 @@ def test_read_entry(req_context):
     # make assertions about the result
 
     assert 'entry' in result
-    assert len(result['entry']) == 4
+    assert len(result['entry']) == 6
 
-    assert expected[0] == result['entry']['title']
-    assert '<p>{}</p>'.format(expected[1]) == result['entry']['text']
+    assert expected[0] == result['entry'].title
+    assert '<p>{}</p>'.format(expected[1]) == result['entry'].text
     for key in 'id', 'created':
-        assert key in result['entry']
+        assert key in result['entry']._fields
 
 
 def test_write_entry(req_context):
@@ -245,6 +250,530 @@ def test_edit_entry(req_context):
     for idx, val in enumerate(expected[0:2]):
         assert val == actual[idx]
 
+def test_execute_prepared(req_context):
+    from journal import execute_prepared
+    now = datetime.datetime.utcnow()
+    cursor = req_context.db.cursor()
+    execute_prepared(cursor, 'insert_entry',
+                     ['Test Title', 'Test Text', None, now])
+    assert 'insert_entry' in req_context.db.prepared
+
+    # a second call re-uses the statement already prepared on the server
+    execute_prepared(cursor, 'insert_entry',
+                     ['Test Title', 'Test Text', None, now])
+    req_context.db.commit()
+    rows = run_query(req_context.db, READ_ENTRY)
+    assert len(rows) == 2
+
+
+def test_execute_prepared_wrong_params():
+    from journal import execute_prepared
+    cursor = mock.Mock()
+    cursor.connection.prepared = set()
+    with pytest.raises(ValueError):
+        execute_prepared(cursor, 'entry', [])
+    # nothing is sent to the server for a call that does not fit
+    assert not cursor.execute.called
+    assert not cursor.connection.prepared
+
+
+def test_rollback_keeps_prepared(req_context):
+    from journal import execute_prepared
+    execute_prepared(req_context.db.cursor(), 'entries_list')
+    assert 'entries_list' in req_context.db.prepared
+    req_context.db.rollback()
+    # PREPARE outlives the transaction, so it must not be sent again
+    assert 'entries_list' in req_context.db.prepared
+    execute_prepared(req_context.db.cursor(), 'entries_list')
+
+
+def test_close_connection_returns_broken_connection():
+    from journal import close_connection
+    pool = mock.Mock()
+    db = mock.Mock()
+    db.commit.side_effect = psycopg2.OperationalError()
+    registry = testing.setUp(settings={'db.pools': {'primary': pool}})
+    try:
+        req = testing.DummyRequest(db=db, db_dsn='primary', exception=None)
+        req.registry = registry.registry
+        with pytest.raises(psycopg2.OperationalError):
+            close_connection(req)
+    finally:
+        testing.tearDown()
+    pool.putconn.assert_called_once_with(db, close=True)
+
+
+def test_iter_entries(req_context):
+    from journal import iter_entries
+    now = datetime.datetime.utcnow()
+    for idx in range(5):
+        run_query(req_context.db, INSERT_ENTRY,
+                  ('Title {}'.format(idx), 'Text', now), False)
+    entries = list(iter_entries(req_context.db, itersize=2))
+    assert [entry.title for entry in entries] == [
+        'Title {}'.format(idx) for idx in range(5)]
+
+
+@pytest.fixture(scope='function')
+def replica_req(request):
+    settings = {
+        'db': 'primary',
+        'db.replicas': ['replica1', 'replica2'],
+        'db.replica_counter': itertools.count(),
+        'db.replicas_down': {},
+        'db.replica_retry': 30,
+    }
+    testing.setUp(settings=settings)
+    req = testing.DummyRequest()
+
+    def cleanup():
+        testing.tearDown()
+
+    request.addfinalizer(cleanup)
+
+    return req
+
+
+def test_reads_round_robin_replicas(replica_req):
+    from journal import candidate_dsns
+    assert candidate_dsns(replica_req) == ['replica1', 'replica2', 'primary']
+    assert candidate_dsns(replica_req) == ['replica2', 'replica1', 'primary']
+
+
+def test_writes_go_to_primary(replica_req):
+    from journal import candidate_dsns
+    replica_req.method = 'POST'
+    assert candidate_dsns(replica_req) == ['primary']
+
+
+def test_reads_after_write_pinned_to_primary(replica_req):
+    from journal import candidate_dsns
+    replica_req.session['db.pinned_until'] = time.time() + 5
+    assert candidate_dsns(replica_req) == ['primary']
+
+
+def test_down_replica_skipped(replica_req):
+    from journal import candidate_dsns
+    settings = replica_req.registry.settings
+    settings['db.replicas_down']['replica1'] = time.time() + 30
+    assert candidate_dsns(replica_req) == ['replica2', 'primary']
+    assert candidate_dsns(replica_req) == ['replica2', 'primary']
+
+
+def dead_connection():
+    db = mock.Mock()
+    db.cursor.return_value.execute.side_effect = psycopg2.OperationalError()
+    return db
+
+
+def test_checkout_replaces_dead_connections():
+    from journal import checkout
+    dead = [dead_connection() for idx in range(3)]
+    live = mock.Mock()
+    pool = mock.Mock(maxconn=3)
+    pool.getconn.side_effect = dead + [live]
+    assert checkout(pool) is live
+    assert pool.putconn.call_args_list == [
+        mock.call(db, close=True) for db in dead]
+
+
+def test_dead_replica_fails_over(replica_req):
+    from journal import connect_request_db
+    settings = replica_req.registry.settings
+    live = mock.Mock()
+    replica, primary = mock.Mock(maxconn=2), mock.Mock(maxconn=2)
+    replica.getconn.side_effect = lambda: dead_connection()
+    primary.getconn.return_value = live
+    settings['db.pools'] = {
+        'replica1': replica, 'replica2': replica, 'primary': primary}
+    assert connect_request_db(replica_req) == ('primary', live)
+    assert set(settings['db.replicas_down']) == set(['replica1', 'replica2'])
+
+
+def test_exhausted_replica_pool_fails_over(replica_req):
+    from journal import connect_request_db
+    from psycopg2.pool import PoolError
+    settings = replica_req.registry.settings
+    live = mock.Mock()
+    replica, primary = mock.Mock(maxconn=2), mock.Mock(maxconn=2)
+    replica.getconn.side_effect = PoolError('connection pool exhausted')
+    primary.getconn.return_value = live
+    settings['db.pools'] = {
+        'replica1': replica, 'replica2': replica, 'primary': primary}
+    assert connect_request_db(replica_req) == ('primary', live)
+    # a busy replica is not a broken one
+    assert settings['db.replicas_down'] == {}
+
+
+def test_pool_sized_for_threads(request):
+    from journal import main
+    os.environ['WEB_THREADS'] = '20'
+    request.addfinalizer(lambda: os.environ.pop('WEB_THREADS'))
+    settings = main().registry.settings
+    assert settings['db.pool_size'] == 21
+
+
+def test_edit_bumps_version(req_context):
+    from journal import edit_entry
+    from journal import write_entry
+    fields = ('title', 'text', 'id')
+    req_context.params = dict(zip(fields, ('Test Title', 'Test Text')))
+    write_entry(req_context)
+    req_context.db.commit()
+    rows = run_query(req_context.db, "SELECT id, version FROM entries")
+    assert rows[0][1] == 1
+
+    req_context.params = dict(zip(fields, ('New Title', 'New Text', rows[0][0])))
+    edit_entry(req_context)
+    req_context.db.commit()
+    rows = run_query(req_context.db, "SELECT id, version FROM entries")
+    assert rows[0][1] == 2
+
+
+def test_render_entry_cached_by_version():
+    from journal import Entry, render_entry
+    now = datetime.datetime.utcnow()
+    original = render_entry(Entry(-1, 'Title', 'Old Text', now, 1, False))
+    assert original.text == '<p>Old Text</p>'
+    # same version, so the cached rendering is served
+    cached = render_entry(Entry(-1, 'Title', 'Ignored', now, 1, False))
+    assert cached.text == '<p>Old Text</p>'
+    edited = render_entry(Entry(-1, 'Title', 'New Text', now, 2, False))
+    assert edited.text == '<p>New Text</p>'
+
+
+def test_render_entry_skips_caching_large_bodies():
+    from journal import CACHE_ITEM_LENGTH, Entry, render_cache, render_entry
+    now = datetime.datetime.utcnow()
+    entry = Entry(-2, 'Title', 'x' * CACHE_ITEM_LENGTH, now, 1, False)
+    render_entry(entry)
+    assert render_cache.get((-2, 1, now, False)) is None
+
+
+def test_fragment_cache_tag():
+    from jinja2 import Environment
+    from journal import FragmentCacheExtension
+    env = Environment(extensions=[FragmentCacheExtension])
+    template = env.from_string(
+        '{% cache "entry", id, version %}{{ text }}{% endcache %}|{{ user }}')
+    assert template.render(id=1, version=1, text='a', user='x') == 'a|x'
+    assert template.render(id=1, version=1, text='b', user='y') == 'a|y'
+    assert template.render(id=1, version=2, text='b', user='y') == 'b|y'
+
+
+def render_pages(app):
+    """render the home, detail and login templates as their views do"""
+    import journal
+    from pyramid.renderers import render
+    from pyramid.threadlocal import manager
+    now = datetime.datetime.utcnow()
+    entry = journal.Entry(1, 'Test Title', '<p>Test Text</p>', now, 1, False)
+    req = testing.DummyRequest()
+    req.registry = app.registry
+    manager.push({'registry': app.registry, 'request': req})
+    try:
+        for name, value in (('templates/list2.jinja2', {'entries': [entry]}),
+                            ('templates/detail.jinja2', {'entry': entry}),
+                            ('templates/login.jinja2', {'error': '',
+                                                        'username': ''})):
+            render(name, value, request=req, package=journal)
+    finally:
+        manager.pop()
+
+
+def test_precompile_templates(request, tmpdir):
+    from journal import main, precompile_templates
+    os.environ['JINJA2_CACHE_DIR'] = str(tmpdir)
+    request.addfinalizer(lambda: os.environ.pop('JINJA2_CACHE_DIR'))
+    names = precompile_templates(main())
+    assert 'journal:templates/list2.jinja2' in names
+    compiled = set(tmpdir.listdir())
+    assert len(compiled) == len(names)
+
+    # a new worker finds everything it renders already compiled, parents
+    # loaded through {% extends %} included
+    render_pages(main())
+    assert set(tmpdir.listdir()) == compiled
+
+
+def test_change_feed_wait():
+    from journal import ChangeFeed
+    feed = ChangeFeed(TEST_DSN)
+    assert feed.wait(0, 0) == (0, [], False)
+    feed.publish({'op': 'new', 'id': 1})
+    feed.publish({'op': 'edit', 'id': 1})
+    assert feed.wait(0, 0) == (2, [{'op': 'new', 'id': 1},
+                                   {'op': 'edit', 'id': 1}], False)
+    assert feed.wait(1, 0) == (2, [{'op': 'edit', 'id': 1}], False)
+    # a cursor from before a restart is treated as current
+    assert feed.wait(10, 0) == (2, [], False)
+
+
+def test_change_feed_wait_busy():
+    from journal import ChangeFeed
+    feed = ChangeFeed(TEST_DSN)
+    feed.waiting = 2
+    start = time.time()
+    assert feed.wait(0, 5, max_waiting=2) == (0, [], True)
+    assert time.time() - start < 1
+
+
+def test_changes_bad_cursor(app):
+    app.get('/changes', params={'cursor': 'abc'}, status=400)
+
+
+def test_write_entry_notifies_feed(req_context):
+    from journal import ChangeFeed, write_entry
+    feed = ChangeFeed(TEST_DSN)
+    feed.start()
+    time.sleep(0.5)
+    req_context.params = {'title': 'Test Title', 'text': 'Test Text'}
+    id = write_entry(req_context)
+    req_context.db.commit()
+    cursor, deltas, busy = feed.wait(0, 5)
+    assert deltas == [{'op': 'new', 'id': id}]
+
+
+def test_iter_blocks():
+    from journal import iter_blocks
+    chunks = ['First para', 'graph\n\n```\ncode\n\nmore', ' code\n```\n\nLast']
+    assert list(iter_blocks(chunks)) == [
+        'First paragraph\n\n',
+        '```\ncode\n\nmore code\n```\n\n',
+        'Last',
+    ]
+
+
+def test_iter_blocks_keeps_lists_together():
+    from journal import iter_blocks, render_markdown
+    text = ('Intro\n\n'
+            '- item\n\n    continued\n\n- loose item\n\n'
+            'After the list\n')
+    blocks = list(iter_blocks([text[:20], text[20:]]))
+    assert blocks == [
+        'Intro\n\n- item\n\n    continued\n\n- loose item\n\n',
+        'After the list\n',
+    ]
+    # rendering block by block gives the same markup as rendering whole
+    streamed = ''.join(render_markdown(block) for block in blocks)
+    whole = render_markdown(text)
+    assert re.sub(r'>\s+<', '><', streamed) == re.sub(r'>\s+<', '><', whole)
+    assert '<pre>' not in streamed
+    assert streamed.count('<ul>') == 1
+
+
+def test_make_excerpt():
+    from journal import EXCERPT_LENGTH, make_excerpt
+    assert make_excerpt('Short Text') is None
+    para = 'x' * (EXCERPT_LENGTH // 2) + '\n\n'
+    assert make_excerpt(para * 4) == para
+    # a long code block is cut and its fence closed
+    excerpt = make_excerpt('```\n' + 'x = 1\n' * EXCERPT_LENGTH)
+    assert excerpt.endswith('\n```\n')
+    excerpt = make_excerpt('~~~\n' + 'x = 1\n' * EXCERPT_LENGTH)
+    assert excerpt.endswith('\n~~~\n')
+
+
+def test_list_shows_excerpt(req_context):
+    from journal import EXCERPT_LENGTH, read_entries, write_entry
+    para = 'x' * (EXCERPT_LENGTH // 2) + '\n\n'
+    req_context.params = {'title': 'Test Title', 'text': para + 'y' * EXCERPT_LENGTH}
+    write_entry(req_context)
+    req_context.db.commit()
+    entry = read_entries(req_context)['entries'][0]
+    assert entry.truncated
+    assert 'x' in entry.text
+    assert 'y' not in entry.text
+
+
+def test_post_new_returns_excerpt(app):
+    from journal import EXCERPT_LENGTH
+    login_helper('admin', 'secret', app)
+    para = 'x' * (EXCERPT_LENGTH // 2) + '\n\n'
+    entry_data = {'title': 'Test Title', 'text': para + 'y' * EXCERPT_LENGTH}
+    entry = app.post('/new', params=entry_data).json
+    assert entry['truncated']
+    assert 'y' not in entry['text']
+
+
+def test_detail_streams_large_entry(db, request):
+    from journal import main
+    from webtest import TestApp
+    os.environ['DATABASE_URL'] = TEST_DSN
+    os.environ['JOURNAL_STREAM_BYTES'] = '100'
+    try:
+        app = TestApp(main())
+    finally:
+        del os.environ['JOURNAL_STREAM_BYTES']
+    request.addfinalizer(lambda: clear_entries(db))
+    text = '\n\n'.join('Paragraph {}'.format(idx) for idx in range(50))
+    with closing(connect_db(db)) as conn:
+        run_query(conn, INSERT_ENTRY,
+                  ('Test Title', text, datetime.datetime.utcnow()), False)
+        id = run_query(conn, READ_ENTRY)[0][0]
+    response = app.get('/detail/{}'.format(id))
+    for idx in range(50):
+        assert '<p>Paragraph {}</p>'.format(idx) in response.body
+
+
+def test_oversized_body_refused(app):
+    from journal import MAX_BODY_BYTES
+    entry_data = {'title': 'Test Title', 'text': 'x' * MAX_BODY_BYTES}
+    app.post('/new', params=entry_data, status=413)
+
+
+@pytest.fixture(scope='function')
+def profile_tween(request, tmpdir):
+    from journal import profile_tween_factory
+    from pyramid.response import Response
+    settings = {
+        'profile.enabled': True,
+        'profile.sample_rate': 0,
+        'profile.token': 'letmein',
+        'profile.directory': str(tmpdir),
+    }
+    registry = testing.setUp(settings=settings).registry
+
+    def cleanup():
+        testing.tearDown()
+
+    request.addfinalizer(cleanup)
+
+    return profile_tween_factory(lambda req: Response('ok'), registry)
+
+
+def test_profile_tween_skips_unsampled(profile_tween, tmpdir):
+    response = profile_tween(testing.DummyRequest())
+    assert response.body == b'ok'
+    assert tmpdir.listdir() == []
+
+
+def test_profile_tween_profiles_on_header(profile_tween, tmpdir):
+    req = testing.DummyRequest(headers={'X-Journal-Profile': 'letmein'})
+    response = profile_tween(req)
+    assert response.body == b'ok'
+    extensions = sorted(path.ext for path in tmpdir.listdir())
+    assert extensions == ['.json', '.pstats']
+
+
+def test_main_profiles_when_enabled(request, tmpdir):
+    from journal import main
+    os.environ['JOURNAL_PROFILE'] = 'true'
+    os.environ['JOURNAL_PROFILE_DIR'] = str(tmpdir)
+
+    def cleanup():
+        del os.environ['JOURNAL_PROFILE']
+        del os.environ['JOURNAL_PROFILE_DIR']
+
+    request.addfinalizer(cleanup)
+    assert main() is not None
+
+
+def test_profile_tween_disabled():
+    from journal import profile_tween_factory
+    registry = testing.setUp(settings={'profile.enabled': False}).registry
+    try:
+        handler = lambda req: None
+        assert profile_tween_factory(handler, registry) is handler
+    finally:
+        testing.tearDown()
+
+
+def test_write_entries(req_context):
+    from journal import write_entries
+    req_context.json_body = [
+        {'title': 'Title {}'.format(idx), 'text': 'Text {}'.format(idx)}
+        for idx in range(3)]
+    entries = write_entries(req_context)
+    req_context.db.commit()
+    assert [entry.title for entry in entries] == [
+        'Title 0', 'Title 1', 'Title 2']
+    rows = run_query(req_context.db, READ_ENTRY)
+    assert len(rows) == 3
+
+
+def test_write_entries_bad_body(req_context):
+    from journal import write_entries
+    for body in ({'title': 'Title'}, [], [{'title': 'Title'}],
+                 [{'title': 'Title', 'text': 5}],
+                 [{'title': ['Title'], 'text': 'Text'}],
+                 [{'title': 'x' * 128, 'text': 'Text'}]):
+        req_context.json_body = body
+        with pytest.raises(ValueError):
+            write_entries(req_context)
+
+
+def test_post_batch(app):
+    login_helper('admin', 'secret', app)
+    entry_data = [{'title': 'Hello there', 'text': '###Header'},
+                  {'title': 'Another', 'text': 'This is a post'}]
+    response = app.post_json('/api/entries/batch', entry_data)
+    entries = response.json['entries']
+    assert [entry['title'] for entry in entries] == ['Hello there', 'Another']
+    assert entries[0]['text'] == '<h3>Header</h3>'
+
+
+def test_post_batch_unauthorized(app):
+    entry_data = [{'title': 'Hello there', 'text': 'This is a post'}]
+    app.post_json('/api/entries/batch', entry_data, status=403)
+
+
+def test_get_batch_not_allowed(app):
+    login_helper('admin', 'secret', app)
+    response = app.get('/api/entries/batch', status='4*')
+    assert response.status_code != 400
+
+
+def test_render_entries_in_pool():
+    import multiprocessing
+    from journal import Entry, render_entries
+    now = datetime.datetime.utcnow()
+    entries = [Entry(-idx, 'Title', 'Text {}'.format(idx), now, 1, False)
+               for idx in range(10, 20)]
+    pool = multiprocessing.Pool(2)
+    try:
+        settings = {'render.pool': pool, 'render.min_parallel': 0}
+        rendered = render_entries(entries, settings)
+    finally:
+        pool.terminate()
+    assert [entry.text for entry in rendered] == [
+        '<p>Text {}</p>'.format(idx) for idx in range(10, 20)]
+
+
+def test_render_entries_pool_timeout_falls_back():
+    import multiprocessing
+    from journal import Entry, render_entries
+    now = datetime.datetime.utcnow()
+    entries = [Entry(-idx, 'Title', 'Text {}'.format(idx), now, 1, False)
+               for idx in range(20, 22)]
+    pool = mock.Mock()
+    pool.map_async.return_value.get.side_effect = multiprocessing.TimeoutError()
+    settings = {'render.pool': pool, 'render.min_parallel': 0}
+    rendered = render_entries(entries, settings)
+    assert [entry.text for entry in rendered] == [
+        '<p>Text 20</p>', '<p>Text 21</p>']
+
+
+def test_read_entries_in_pool(req_context):
+    import multiprocessing
+    from journal import read_entries
+    now = datetime.datetime.utcnow()
+    for idx in range(3):
+        run_query(req_context.db, INSERT_ENTRY,
+                  ('Title {}'.format(idx), 'Text {}'.format(idx), now), False)
+    pool = multiprocessing.Pool(2)
+    try:
+        config = testing.setUp(
+            settings={'render.pool': pool, 'render.min_parallel': 0})
+        req_context.registry = config.registry
+        result = read_entries(req_context)
+    finally:
+        testing.tearDown()
+        pool.terminate()
+    assert sorted(entry.text for entry in result['entries']) == [
+        '<p>Text {}</p>'.format(idx) for idx in range(3)]
+
+
 # Obsolete with ajax
 
 # def test_post_to_add_view(app):